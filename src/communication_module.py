@@ -15,7 +15,7 @@ class CommunicationModule(object):
         self.socket = self.context.socket(zmq.REQ)
 
     def start(self):
-        logger.debug(f"Starting communication module ('{self.host}:{self.port}')")
+        logger.debug("Starting communication module ('%s:%s')", self.host, self.port)
         self.socket.connect(f"tcp://{self.host}:{self.port}")
 
     def stop(self):
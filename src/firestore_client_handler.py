@@ -99,7 +99,7 @@ class FirestoreClientHandler:
     def _get_credentials(self):
         user_id, token_id = self._get_ids()
         if not user_id or not token_id:
-            logger.debug(f"Invalid user and token ids ({user_id}, {token_id})")
+            logger.debug("Invalid user and token ids (%s, %s)", user_id, token_id)
             return None
         self.user_id = user_id
         creds = Credentials(token_id, self.refresh_token)
@@ -149,8 +149,8 @@ class ServerResponseMessageHandler(logging.StreamHandler):
             logger.debug("Server connection timeout detected")
             threading.Thread(target=self.on_server_not_responding).start()
         if self.server_response_msg in msg:
-            logger.debug("Server response message caught ({} seconds)".format(
-                time.time() - self.server_response_last_time))
+            logger.debug("Server response message caught (%s seconds)",
+                         time.time() - self.server_response_last_time)
             self.server_response_last_time = time.time()
             if self.not_responding_timer:
                 self.stop()
@@ -2,15 +2,28 @@ import logging
 import os
 import shutil
 import threading
-from typing import Any, Dict, List, Optional, TypedDict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypedDict
 
 import yaml
-from google.cloud.firestore_v1 import DocumentReference, DocumentSnapshot
+from google.cloud.firestore_v1 import (
+    CollectionReference,
+    DocumentReference,
+    DocumentSnapshot,
+)
 from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
 from proto.datetime_helpers import DatetimeWithNanoseconds
 
 from firestore_client_handler import FirestoreClientHandler
 
+try:
+    from yaml import CSafeDumper as Dumper
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeDumper as Dumper
+    from yaml import SafeLoader as Loader
+
 logger = logging.getLogger(__name__)
 
 
@@ -39,6 +52,9 @@ class InstalledServicesDownloader(FirestoreClientHandler):
     """
 
     RESTART_DELAY_TIME_S = 0.5
+    MODIFIED_DEBOUNCE_TIME_S = 0.3
+    SYNC_MAX_WORKERS = 4
+    REMOTE_COMPOSES_MAX_SIZE = 128
 
     user_id: str
     """Id of the owner of the device."""
@@ -46,10 +62,34 @@ class InstalledServicesDownloader(FirestoreClientHandler):
     """Id of the device."""
     device: Optional[DocumentReference]
     """Reference to the firestore document of this device."""
-    services: List[str]
+    installed_services: Optional[CollectionReference]
+    """Reference to the firestore installed services collection of this device."""
+    services: Set[str]
     """The services in the local iombian."""
+    services_lock: threading.Lock
+    """Lock that guards every modification of `services`, which happens from the sync workers, the listener and the update timers."""
     base_path: str
     """The base path where the services are installed (normally "/opt/iombian-services")."""
+    local_versions: Dict[str, Tuple[Tuple[int, int], str]]
+    """Cache of the local service versions, keyed by the `(st_mtime_ns, st_size)` of their compose file."""
+    local_envs: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]]
+    """Cache of the local service envs, keyed by the `(st_mtime_ns, st_size)` of their env file."""
+    remote_composes: "OrderedDict[Tuple[str, str], Dict[str, Any]]"
+    """LRU cache of the remote docker composes, keyed by `(service_name, version)` (a version is never modified)."""
+    remote_composes_lock: threading.Lock
+    """Lock that guards `remote_composes`."""
+    change_handlers: Dict[ChangeType, Callable[[str, DocumentSnapshot], None]]
+    """Functions that handle each type of change in the installed services."""
+    restart_timer: Optional[threading.Timer]
+    """Timer of the pending restart, if any."""
+    restart_lock: threading.Lock
+    """Lock that guards `restart_timer`."""
+    pending_updates: Dict[str, threading.Timer]
+    """Timers of the modified services waiting to be updated, keyed by service name."""
+    pending_updates_lock: threading.Lock
+    """Lock that guards `pending_updates`."""
+    service_locks: Dict[str, threading.Lock]
+    """Locks that serialize the install and removal of each service, keyed by service name."""
 
     def __init__(
         self,
@@ -62,8 +102,40 @@ class InstalledServicesDownloader(FirestoreClientHandler):
         super().__init__(api_key, project_id, refresh_token)
         self.device_id = device_id
         self.device = None
-        self.services = []
+        self.installed_services = None
+        self.services = set()
+        self.services_lock = threading.Lock()
         self.base_path = base_path
+        self.local_versions = {}
+        self.local_envs = {}
+        self.remote_composes = OrderedDict()
+        self.remote_composes_lock = threading.Lock()
+        self.change_handlers = {
+            ChangeType.ADDED: self._on_service_added,
+            ChangeType.REMOVED: self._on_service_removed,
+            ChangeType.MODIFIED: self._on_service_modified,
+        }
+        self.restart_timer = None
+        self.restart_lock = threading.Lock()
+        self.pending_updates = {}
+        self.pending_updates_lock = threading.Lock()
+        self.service_locks = {}
+
+    @staticmethod
+    def _get_file_key(path: str) -> Tuple[int, int]:
+        """Get the key that identifies the current content of the file given its path.
+
+        If the file is modified the key changes, so it is used to invalidate the cached local values.
+        """
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def _get_compose_version(service_name: str, docker_compose: Dict[str, Any]) -> str:
+        """Get the version label of the service given the service name and the parsed docker compose."""
+        return docker_compose["services"][service_name]["labels"][
+            f"com.{service_name}.service.version"
+        ]
 
     def _get_local_version(self, service_name: str) -> str:
         """Get the version of the local service given the service name.
@@ -71,29 +143,46 @@ class InstalledServicesDownloader(FirestoreClientHandler):
         """
         compose_path = f"{self.base_path}/{service_name}/docker-compose.yaml"
         try:
-            with open(compose_path, "r") as docker_compose_txt:
-                docker_compose = yaml.safe_load(docker_compose_txt)
+            file_key = self._get_file_key(compose_path)
+            cached = self.local_versions.get(service_name)
+            if cached and cached[0] == file_key:
+                return cached[1]
 
-            local_version = docker_compose["services"][service_name]["labels"][
-                f"com.{service_name}.service.version"
-            ]
+            with open(compose_path, "rb") as docker_compose_file:
+                docker_compose_bytes = docker_compose_file.read()
+
+            docker_compose = yaml.load(docker_compose_bytes, Loader=Loader)
+
+            local_version = self._get_compose_version(service_name, docker_compose)
+            self.local_versions[service_name] = (file_key, local_version)
             return local_version
-        except:
-            logger.warning(f"Invalid local serivce {service_name}")
-            raise InvalidLocalService
+        except (OSError, yaml.YAMLError, KeyError, TypeError) as e:
+            logger.warning("Invalid local serivce %s", service_name)
+            raise InvalidLocalService from e
 
-    def _get_remote_version(self, service_snapshot: DocumentSnapshot) -> str:
-        """Get the version of the remote service given the services `DocumentSnapshot`.
+    def _get_remote_service(self, service_snapshot: DocumentSnapshot) -> Dict[str, Any]:
+        """Get the fields of the remote service given the services `DocumentSnapshot`.
         The remote service is the one in firebase.
+
+        `to_dict()` builds a new dict on every call, so the fields are read once and passed to the other `_get_remote_*` methods.
+        If the remote service has no fields raise a `InvalidRemoteService` error.
         """
         service_dict = service_snapshot.to_dict()
         if service_dict is None:
-            logger.warning(f"Invalid remote serivce {service_snapshot.id}")
+            logger.warning("Invalid remote serivce %s", service_snapshot.id)
             raise InvalidRemoteService
 
+        return service_dict
+
+    def _get_remote_version(
+        self, service_name: str, service_dict: Dict[str, Any]
+    ) -> str:
+        """Get the version of the remote service given the service name and its fields.
+        The remote service is the one in firebase.
+        """
         version = service_dict.get("version")
         if version is None:
-            logger.warning(f"Invalid remote serivce {service_snapshot.id}")
+            logger.warning("Invalid remote serivce %s", service_name)
             raise InvalidRemoteService
 
         return version
@@ -102,108 +191,297 @@ class InstalledServicesDownloader(FirestoreClientHandler):
         """Get the environment variables of the local service given the service name.
         The local service is the one installed on the iombian.
 
+        Lines are split on `\n` and a trailing `\r` is dropped, so files with CRLF line endings are read the same way.
+        Empty lines and lines starting with `#` are ignored.
         If the local service or env is not found or the envs don't follow the given structure raise a `InvalidLocalService` error.
         """
         envs: Dict[str, Any] = {}
         env_path = f"{self.base_path}/{service_name}/.env"
         try:
-            with open(env_path, "r") as env_txt:
-                lines = env_txt.readlines()
-
-            for line in lines:
-                if "\n" in line:
-                    line = line[:-1]
-                key, value = line.split("=")
+            file_key = self._get_file_key(env_path)
+            cached = self.local_envs.get(service_name)
+            if cached and cached[0] == file_key:
+                return cached[1]
+
+            with open(env_path, "rb") as env_file:
+                env_text = env_file.read().decode("utf-8")
+
+            for line in env_text.split("\n"):
+                line = line.removesuffix("\r")
+                if not line or line.startswith("#"):
+                    continue
+                key, value = line.split("=", 1)
                 envs[key] = value
+            self.local_envs[service_name] = (file_key, envs)
             return envs
-        except:
-            logger.warning(f"Invalid remote serivce {service_name}")
-            raise InvalidLocalService
-
-    def _get_remote_envs(self, service_snapshot: DocumentSnapshot) -> Dict[str, Any]:
-        """Get the environment variables of the remote service given the services `DocumentSnapshot`.
+        except (OSError, ValueError) as e:
+            logger.warning("Invalid local serivce %s", service_name)
+            raise InvalidLocalService from e
+
+    def _get_remote_envs(
+        self, service_name: str, service_dict: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Get the environment variables of the remote service given the service name and its fields.
         The remote service is the one installed in firebase.
 
-        If the remote service has no fields or the fields don't have a env field raise a `InvalidRemoteService` error.
+        If the fields don't have a env field raise a `InvalidRemoteService` error.
         """
-        service_dict = service_snapshot.to_dict()
-        if service_dict is None:
-            logger.warning(f"Invalid remote serivce {service_snapshot.id}")
-            raise InvalidRemoteService
-
         envs = service_dict.get("envs")
         if envs is None:
-            logger.warning(f"Invalid remote serivce {service_snapshot.id}")
+            logger.warning("Invalid remote serivce %s", service_name)
             raise InvalidRemoteService
 
         return envs
 
     def _get_remote_compose(
-        self, service_name: str, service_snapshot: DocumentSnapshot
+        self, service_name: str, service_dict: Dict[str, Any]
     ) -> Optional[Dict[str, Any]]:
-        """Get the docker compose of the remote service given the service name and `DocumentSnapshot`.
+        """Get the docker compose of the remote service given the service name and its fields.
         The remote service is the one installed in firebase.
+
+        The composes are cached, so each service version is only fetched from firebase once.
         """
         try:
-            version = self._get_remote_version(service_snapshot)
+            version = self._get_remote_version(service_name, service_dict)
         except InvalidRemoteService:
             return None
 
-        service_dict = (
+        compose_key = (service_name, version)
+        compose = self._get_cached_compose(compose_key)
+        if compose is not None:
+            return compose
+
+        version_reference = self._get_remote_version_reference(service_name, version)
+        compose = self._get_version_compose(version_reference.get())
+        if compose is not None:
+            self._cache_compose(compose_key, compose)
+        return compose
+
+    def _get_cached_compose(
+        self, compose_key: Tuple[str, str]
+    ) -> Optional[Dict[str, Any]]:
+        """Get the cached docker compose given its `(service_name, version)` key, if any."""
+        with self.remote_composes_lock:
+            compose = self.remote_composes.get(compose_key)
+            if compose is not None:
+                self.remote_composes.move_to_end(compose_key)
+            return compose
+
+    def _cache_compose(self, compose_key: Tuple[str, str], compose: Dict[str, Any]):
+        """Store the docker compose in the cache given its `(service_name, version)` key.
+
+        If the cache has more than `REMOTE_COMPOSES_MAX_SIZE` composes, the least recently used one is discarded.
+        """
+        with self.remote_composes_lock:
+            self.remote_composes[compose_key] = compose
+            self.remote_composes.move_to_end(compose_key)
+            if len(self.remote_composes) > self.REMOTE_COMPOSES_MAX_SIZE:
+                self.remote_composes.popitem(last=False)
+
+    def _get_remote_version_reference(
+        self, service_name: str, version: str
+    ) -> DocumentReference:
+        """Get the reference to the firestore document of the service version given the service name and version."""
+        return (
             self.client.collection("services")
             .document(service_name)
             .collection("versions")
             .document(version)
-            .get()
-            .to_dict()
         )
-        if service_dict is None:
+
+    @staticmethod
+    def _get_version_compose(
+        version_snapshot: DocumentSnapshot,
+    ) -> Optional[Dict[str, Any]]:
+        """Get the docker compose of the service version given its `DocumentSnapshot`."""
+        version_dict = version_snapshot.to_dict()
+        if version_dict is None:
             return None
 
-        return service_dict.get("compose")
+        return version_dict.get("compose")
+
+    def _prefetch_remote_composes(self, service_snapshots: List[DocumentSnapshot]):
+        """Fetch the docker composes of the remote services given their `DocumentSnapshot`.
+
+        All the composes that are not cached are fetched from firebase in a single request and stored in `remote_composes`.
+        """
+        version_references: List[DocumentReference] = []
+        compose_keys: Dict[str, Tuple[str, str]] = {}
+        for service_snapshot in service_snapshots:
+            try:
+                version = service_snapshot.get("version")
+            except KeyError:
+                continue
+            if version is None:
+                continue
+            compose_key = (service_snapshot.id, version)
+            if self._get_cached_compose(compose_key) is not None:
+                continue
+            version_reference = self._get_remote_version_reference(
+                service_snapshot.id, version
+            )
+            version_references.append(version_reference)
+            compose_keys[version_reference.path] = compose_key
+
+        if not version_references:
+            return
+
+        for version_snapshot in self.client.get_all(version_references):
+            compose = self._get_version_compose(version_snapshot)
+            if compose is not None:
+                compose_key = compose_keys[version_snapshot.reference.path]
+                self._cache_compose(compose_key, compose)
 
     def read_local_services(self):
         """Read the local services and compare them with the ones in firebase.
 
-        Read all the services on the `base_path`.
+        Read all the services on the `base_path` (every folder that is not hidden is a service).
+        The `.{name}.new` and `.{name}.old` folders left by an interrupted install are cleaned up first.
         For each service, if the service is on firebase, compare the services.
         Depending on the result of the comparison update the service or do nothing.
         If the service is not in firebase, this mean that it was removed while the iombian was off, so remove the service from the iombian.
 
         If the service in firebase is not valid remove the service from the iombian.
         If the service in the iombian is not valid update the service.
+
+        The services are independent from each other, so they are synced in parallel.
+        The outdated services are found first, so their docker composes are fetched from firebase in a single request before installing them.
         """
         logger.debug("Syncing local and remote services")
-        self.services = os.listdir(self.base_path)
-        for service_name in self.services:
-            service_snapshot = None
-            if self.device:
-                service_reference = self.device.collection(
-                    "installed_services"
-                ).document(service_name)
-                service_snapshot = service_reference.get()
-
-            if service_snapshot and service_snapshot.exists:
-                try:
-                    logger.debug(service_name)
-                    logger.debug(service_snapshot)
-                    if not self.compare(service_name, service_snapshot):
-                        self.remove_service(service_name)
-                        self.install_service(service_name, service_snapshot)
-                    else:
-                        logger.debug(f"Service {service_name} is up to date")
-                except InvalidRemoteService:
-                    self.remove_service(service_name)
-                    self.services.remove(service_name)
-                except InvalidLocalService:
-                    self.remove_service(service_name)
-                    try:
-                        self.install_service(service_name, service_snapshot)
-                    except:
-                        self.services.remove(service_name)
-
-            else:
+        service_names: List[str] = []
+        stale_paths: List[str] = []
+        with os.scandir(self.base_path) as entries:
+            for entry in entries:
+                if not entry.name.startswith("."):
+                    if entry.is_dir():
+                        service_names.append(entry.name)
+                elif entry.name.endswith((".new", ".old")):
+                    stale_paths.append(entry.path)
+        for stale_path in stale_paths:
+            restored_service = self._clean_stale_folder(stale_path)
+            if restored_service:
+                service_names.append(restored_service)
+        with self.services_lock:
+            self.services = set(service_names)
+        if not service_names:
+            return
+
+        service_snapshots = self._get_remote_services(service_names)
+        with ThreadPoolExecutor(max_workers=self.SYNC_MAX_WORKERS) as executor:
+            service_dicts = executor.map(
+                self._check_local_service,
+                service_names,
+                [service_snapshots.get(name) for name in service_names],
+            )
+            outdated_services = [
+                (service_name, service_dict)
+                for service_name, service_dict in zip(service_names, service_dicts)
+                if service_dict is not None
+            ]
+            if not outdated_services:
+                return
+
+            self._prefetch_remote_composes(
+                [service_snapshots[name] for name, _ in outdated_services]
+            )
+            list(
+                executor.map(
+                    self._install_local_service,
+                    [name for name, _ in outdated_services],
+                    [service_snapshots[name] for name, _ in outdated_services],
+                    [service_dict for _, service_dict in outdated_services],
+                )
+            )
+
+    def _clean_stale_folder(self, path: str) -> Optional[str]:
+        """Given the path of a `.{name}.new` or `.{name}.old` folder left by an interrupted install, clean it up.
+
+        If the install was interrupted after the service folder was moved aside, the `.old` folder is the only copy of the service, so it is restored and the service name is returned.
+        Otherwise the folder is removed and `None` is returned.
+        """
+        service_name = os.path.basename(path)[1:-4]
+        service_path = f"{self.base_path}/{service_name}"
+        if path.endswith(".old") and not os.path.lexists(service_path):
+            try:
+                os.rename(path, service_path)
+                logger.debug("Restored %s service", service_name)
+                return service_name
+            except OSError as e:
+                logger.warning("Could not restore %s service: %s", service_name, e)
+                return None
+
+        self._remove_folder(path)
+        return None
+
+    def _get_remote_services(
+        self, service_names: List[str]
+    ) -> Dict[str, DocumentSnapshot]:
+        """Get the `DocumentSnapshot` of the remote services given the service names.
+
+        All the services are fetched from firebase in a single request.
+        """
+        if not self.installed_services or not service_names:
+            return {}
+
+        service_references = [
+            self.installed_services.document(service_name)
+            for service_name in service_names
+        ]
+        return {
+            service_snapshot.id: service_snapshot
+            for service_snapshot in self.client.get_all(service_references)
+        }
+
+    def _check_local_service(
+        self, service_name: str, service_snapshot: Optional[DocumentSnapshot]
+    ) -> Optional[Dict[str, Any]]:
+        """Given the service name and `DocumentSnapshot`, compare the local service with the one in firebase.
+
+        Return the fields of the remote service if the local service has to be installed again, or `None` if not.
+        If the service has to be removed from the iombian, it is removed and also removed from `services`.
+        """
+        if not (service_snapshot and service_snapshot.exists):
+            self.remove_service(service_name)
+            self._forget_service(service_name)
+            return None
+
+        try:
+            logger.debug(service_name)
+            logger.debug(service_snapshot)
+            service_dict = self._get_remote_service(service_snapshot)
+            if self.compare(service_name, service_snapshot, service_dict):
+                logger.debug("Service %s is up to date", service_name)
+                return None
+        except InvalidRemoteService:
+            self.remove_service(service_name)
+            self._forget_service(service_name)
+            return None
+        except InvalidLocalService:
+            pass
+
+        return service_dict
+
+    def _install_local_service(
+        self,
+        service_name: str,
+        service_snapshot: DocumentSnapshot,
+        service_dict: Dict[str, Any],
+    ):
+        """Given the service name, `DocumentSnapshot` and fields, install again the outdated local service.
+
+        If the service in firebase is not valid, the service is removed from the iombian and from `services`.
+        """
+        with self._get_service_lock(service_name):
+            try:
+                self.install_service(service_name, service_snapshot, service_dict)
+            except InvalidRemoteService:
                 self.remove_service(service_name)
+                self._forget_service(service_name)
+
+    def _forget_service(self, service_name: str):
+        """Given the service name, remove the service from `services`."""
+        with self.services_lock:
+            self.services.discard(service_name)
 
     def start(self):
         """Start the Installed Services Downloader by starting the listener, syncing with the remote and starting the firestore connection."""
@@ -215,17 +493,33 @@ class InstalledServicesDownloader(FirestoreClientHandler):
             .collection("devices")
             .document(self.device_id)
         )
+        self.installed_services = self.device.collection("installed_services")
         self.read_local_services()
-        self.watch = self.device.collection("installed_services").on_snapshot(
+        self.watch = self.installed_services.on_snapshot(
             self._on_installed_service_change
         )
 
     def stop(self):
-        """Stop the downloader by stopping the listener and the firestore connection."""
+        """Stop the downloader by stopping the listener and the firestore connection.
+
+        The pending updates are cancelled and the installs or removals that are already running are waited for before stopping the connection.
+        """
         logger.info("Installed Services Downloader stopped.")
+        with self.restart_lock:
+            if self.restart_timer:
+                self.restart_timer.cancel()
+                self.restart_timer = None
         if self.watch is not None:
             self.watch.unsubscribe()
+        with self.pending_updates_lock:
+            for update_timer in self.pending_updates.values():
+                update_timer.cancel()
+            self.pending_updates.clear()
+        for service_lock in list(self.service_locks.values()):
+            with service_lock:
+                pass
         self.device = None
+        self.installed_services = None
         self.stop_client()
 
     def restart(self):
@@ -235,48 +529,130 @@ class InstalledServicesDownloader(FirestoreClientHandler):
 
     def remove_service(self, service_name: str):
         """Given the service name, remove the service from the IoMBian device."""
-        logger.debug(f"Removing {service_name} service")
+        logger.debug("Removing %s service", service_name)
+        self._invalidate_local_cache(service_name)
         service_path = f"{self.base_path}/{service_name}"
+        shutil.rmtree(service_path, onerror=self._on_remove_error)
+
+    @staticmethod
+    def _on_remove_error(function: Callable, path: str, exc_info: Tuple):
+        """Error handler of `shutil.rmtree` that ignores the files that do not exist and logs the other errors."""
+        if issubclass(exc_info[0], FileNotFoundError):
+            return
+        logger.warning("Could not remove %s: %s", path, exc_info[1])
+
+    def _remove_folder(self, path: str):
+        """Remove the folder given its path. If the path is a symbolic link, the link is removed but not its target.
+
+        Missing folders are ignored and the other errors are logged.
+        """
+        if not os.path.islink(path):
+            shutil.rmtree(path, onerror=self._on_remove_error)
+            return
+
         try:
-            shutil.rmtree(service_path)
-        except:
-            logger.debug(f"Service {service_name} was already removed")
-            pass
+            os.unlink(path)
+        except OSError as e:
+            logger.warning("Could not remove %s: %s", path, e)
 
-    def install_service(self, service_name: str, service_snapshot: DocumentSnapshot):
-        """Given the service name and `DocumentSnapshot`, install the service from firebase."""
-        logger.debug(f"Installing {service_name} Service")
-        compose = self._get_remote_compose(service_name, service_snapshot)
-        envs_dict = self._get_remote_envs(service_snapshot)
+    def install_service(
+        self,
+        service_name: str,
+        service_snapshot: DocumentSnapshot,
+        service_dict: Optional[Dict[str, Any]] = None,
+    ) -> bool:
+        """Given the service name and `DocumentSnapshot`, install the service from firebase and return `True` if it was installed.
+
+        The service is written in a hidden temporary folder that then replaces the service folder, so an installed service is never left half written.
+        The previous service folder is moved aside before the swap and only removed once the new one is in place.
+        If the service can not be written or the folders can not be swapped, the error is logged, the previous service folder is restored and `False` is returned.
+        If the fields of the snapshot were already read, pass them in `service_dict` so they are not read again.
+        """
+        logger.debug("Installing %s Service", service_name)
+        if service_dict is None:
+            service_dict = self._get_remote_service(service_snapshot)
+        compose = self._get_remote_compose(service_name, service_dict)
+        envs_dict = self._get_remote_envs(service_name, service_dict)
+
+        compose_bytes = yaml.dump(
+            compose,
+            Dumper=Dumper,
+            default_flow_style=False,
+            sort_keys=False,
+            encoding="utf-8",
+        )
+        envs_bytes = "".join(
+            f"{key}={value}\n" for key, value in envs_dict.items()
+        ).encode("utf-8")
 
+        tmp_path = f"{self.base_path}/.{service_name}.new"
+        old_path = f"{self.base_path}/.{service_name}.old"
         service_path = f"{self.base_path}/{service_name}"
+        self._remove_folder(tmp_path)
+        self._remove_folder(old_path)
+        self._invalidate_local_cache(service_name)
+        moved_aside = False
         try:
-            os.mkdir(service_path)
-        except FileExistsError:
+            os.makedirs(tmp_path)
+            self._write_file(f"{tmp_path}/docker-compose.yaml", compose_bytes)
+            self._write_file(f"{tmp_path}/.env", envs_bytes)
+            if os.path.lexists(service_path):
+                os.rename(service_path, old_path)
+                moved_aside = True
+            os.rename(tmp_path, service_path)
+        except OSError as e:
+            logger.error("Could not install %s service: %s", service_name, e)
+            if moved_aside:
+                os.rename(old_path, service_path)
+            self._remove_folder(tmp_path)
+            return False
+
+        self._remove_folder(old_path)
+
+        try:
+            version = self._get_compose_version(service_name, compose)
+            self.local_versions[service_name] = (
+                self._get_file_key(f"{service_path}/docker-compose.yaml"),
+                version,
+            )
+        except (KeyError, TypeError):
             pass
+        return True
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        """Write the data in the file given its path."""
+        with open(path, "wb") as file:
+            file.write(data)
 
-        with open(
-            f"{self.base_path}/{service_name}/docker-compose.yaml", "w"
-        ) as compose_file:
-            yaml.dump(compose, compose_file)
+    def _invalidate_local_cache(self, service_name: str):
+        """Given the service name, remove the cached local version and envs of the service."""
+        self.local_versions.pop(service_name, None)
+        self.local_envs.pop(service_name, None)
 
-        envs_list = [f"{key}={envs_dict[key]}\n" for key in envs_dict]
-        with open(f"{self.base_path}/{service_name}/.env", "w") as env_file:
-            env_file.writelines(envs_list)
+    def compare(
+        self,
+        service_name: str,
+        service_snapshot: DocumentSnapshot,
+        service_dict: Optional[Dict[str, Any]] = None,
+    ):
+        """Return `True` if local and remote service are the same. If not return `False`.
 
-    def compare(self, service_name: str, service_snapshot: DocumentSnapshot):
-        """Return `True` if local and remote service are the same. If not return `False`."""
-        remote_version = self._get_remote_version(service_snapshot)
+        If the fields of the snapshot were already read, pass them in `service_dict` so they are not read again.
+        """
+        if service_dict is None:
+            service_dict = self._get_remote_service(service_snapshot)
+        remote_version = self._get_remote_version(service_name, service_dict)
         local_version = self._get_local_version(service_name)
-        logger.debug(f"Local version: {local_version}")
-        logger.debug(f"Remote version: {remote_version}")
+        logger.debug("Local version: %s", local_version)
+        logger.debug("Remote version: %s", remote_version)
         if local_version != remote_version:
             return False
 
-        remote_envs = self._get_remote_envs(service_snapshot)
+        remote_envs = self._get_remote_envs(service_name, service_dict)
         local_envs = self._get_local_envs(service_name)
-        logger.debug(f"Local envs: {local_envs}")
-        logger.debug(f"Remote envs: {remote_envs}")
+        logger.debug("Local envs: %s", local_envs)
+        logger.debug("Remote envs: %s", remote_envs)
         return local_envs == remote_envs
 
     def on_client_initialized(self):
@@ -290,7 +666,21 @@ class InstalledServicesDownloader(FirestoreClientHandler):
     def on_token_expired(self):
         """Callback function when the token is expired."""
         logger.debug("Refreshing Firebase client token id")
-        threading.Timer(self.RESTART_DELAY_TIME_S, self.restart).start()
+        self._schedule_restart()
+
+    def _schedule_restart(self):
+        """Restart the Installed Services Downloader after `RESTART_DELAY_TIME_S` seconds.
+
+        If a restart is already pending it is replaced, so a burst of restart requests only restarts the downloader once.
+        """
+        with self.restart_lock:
+            if self.restart_timer:
+                self.restart_timer.cancel()
+            self.restart_timer = threading.Timer(
+                self.RESTART_DELAY_TIME_S, self.restart
+            )
+            self.restart_timer.daemon = True
+            self.restart_timer.start()
 
     def _on_installed_service_change(
         self,
@@ -303,29 +693,102 @@ class InstalledServicesDownloader(FirestoreClientHandler):
         There can be three type of changes:
             - ADDED: install the service from firebase.
             - REMOVED: remove the service from the iombian.
-            - MODIFIED: update the service by removing and installing it again.
+            - MODIFIED: update the service by installing it again.
+              Changes of the same service that arrive within `MODIFIED_DEBOUNCE_TIME_S` are applied only once.
+
+        The docker composes of the added services that are going to be installed are fetched together before handling the changes.
+        The modified services fetch their docker compose when the update runs, so only the last modification is fetched.
         """
+        self._prefetch_remote_composes(
+            [
+                change.document
+                for change in changes
+                if change.type == ChangeType.ADDED
+                and change.document.id not in self.services
+            ]
+        )
         for change in changes:
             service_snapshot = change.document
-            service_name = service_snapshot.id
+            change_handler = self.change_handlers.get(change.type)
+            if change_handler:
+                change_handler(service_snapshot.id, service_snapshot)
+
+    def _get_service_lock(self, service_name: str) -> threading.Lock:
+        """Given the service name, get the lock that serializes the install and removal of the service."""
+        return self.service_locks.setdefault(service_name, threading.Lock())
+
+    def _on_service_added(self, service_name: str, service_snapshot: DocumentSnapshot):
+        """Install the added service from firebase if it is not already installed."""
+        with self._get_service_lock(service_name):
+            if service_name not in self.services:
+                try:
+                    if self.install_service(service_name, service_snapshot):
+                        with self.services_lock:
+                            self.services.add(service_name)
+                except InvalidRemoteService:
+                    pass
 
-            if change.type == ChangeType.ADDED:
-                if service_name not in self.services:
-                    try:
-                        self.install_service(service_name, service_snapshot)
-                        self.services.append(service_name)
-                    except InvalidRemoteService:
-                        pass
+    def _on_service_removed(
+        self, service_name: str, service_snapshot: DocumentSnapshot
+    ):
+        """Remove the removed service from the iombian.
 
-            elif change.type == ChangeType.REMOVED:
-                self.remove_service(service_name)
-                if service_name in self.services:
-                    self.services.remove(service_name)
+        If the service is being updated, it is removed after the update finishes.
+        """
+        self._cancel_pending_update(service_name)
+        with self._get_service_lock(service_name):
+            self.remove_service(service_name)
+            self._forget_service(service_name)
 
-            elif change.type == ChangeType.MODIFIED:
+    def _on_service_modified(
+        self, service_name: str, service_snapshot: DocumentSnapshot
+    ):
+        """Schedule the update of the modified service.
+
+        If the service is modified again before `MODIFIED_DEBOUNCE_TIME_S`, only the last modification is applied.
+        """
+        with self.pending_updates_lock:
+            update_timer = self.pending_updates.get(service_name)
+            if update_timer:
+                update_timer.cancel()
+            update_timer = threading.Timer(
+                self.MODIFIED_DEBOUNCE_TIME_S,
+                self._update_service,
+                args=(service_name, service_snapshot),
+            )
+            update_timer.daemon = True
+            self.pending_updates[service_name] = update_timer
+            update_timer.start()
+
+    def _cancel_pending_update(self, service_name: str):
+        """Given the service name, cancel the pending update of the service, if any."""
+        with self.pending_updates_lock:
+            update_timer = self.pending_updates.pop(service_name, None)
+            if update_timer:
+                update_timer.cancel()
+
+    def _update_service(self, service_name: str, service_snapshot: DocumentSnapshot):
+        """Given the service name and `DocumentSnapshot`, update the service by installing it again.
+
+        If the update was cancelled or replaced by a newer one while waiting for the service lock, nothing is done.
+        """
+        with self._get_service_lock(service_name):
+            with self.pending_updates_lock:
+                if (
+                    self.pending_updates.get(service_name)
+                    is not threading.current_thread()
+                ):
+                    return
+
+            try:
+                self.install_service(service_name, service_snapshot)
+            except InvalidRemoteService:
                 self.remove_service(service_name)
-                try:
-                    self.install_service(service_name, service_snapshot)
-                except InvalidRemoteService:
-                    if service_name in self.services:
-                        self.services.remove(service_name)
+                self._forget_service(service_name)
+            finally:
+                with self.pending_updates_lock:
+                    if (
+                        self.pending_updates.get(service_name)
+                        is threading.current_thread()
+                    ):
+                        del self.pending_updates[service_name]
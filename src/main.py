@@ -17,7 +17,7 @@ logger = logging.getLogger(__name__)
 
 
 def signal_handler(sig, frame):
-    logger.warn("Stopping the service")
+    logger.warning("Stopping the service")
     comm_module.stop()
     installed_services_downloader.stop()
 